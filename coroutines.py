@@ -1,8 +1,8 @@
+import asyncio
 import math
 import random
-from time import sleep
 
-from postgres_to_es.utils import coroutine
+from postgres_to_es.utils import async_coroutine, coroutine
 
 
 def cash_return(deposit: int, percent: float, years: int) -> float:
@@ -10,69 +10,66 @@ def cash_return(deposit: int, percent: float, years: int) -> float:
     return round(deposit * value, 2)
 
 
-def cash_return_coro(percent: float, years: int) -> float:
+@coroutine
+def cash_return_coro(percent: float, years: int, sink):
     value = math.pow(1 + percent / 100, years)
-    while True:
-        try:
-            deposit = yield
-            yield round(deposit * value, 2)
-        except GeneratorExit:
-            print("Выход из корутины")
+    while (deposit := (yield)) is not None:
+        sink.send(round(deposit * value, 2))
 
 
 def run_cash_return_coro():
-    coro = cash_return_coro(5, 5)
-    next(coro)
+    coro = cash_return_coro(5, 5, print_value())
     values = [1000, 2000, 5000, 10000, 100000]
     for item in values:
-        print(coro.send(item))
-        next(coro)
+        coro.send(item)
     coro.close()
 
 
-def double_it():
-    while True:
-        try:
-            number = yield
-            yield pow(number, 2)
-        except GeneratorExit:
-            print("Exit")
+@coroutine
+def double_it(sink):
+    while (number := (yield)) is not None:
+        sink.send(pow(number, 2))
 
 
 def run_double_it_coro():
-    coro = double_it()
-    next(coro)
+    coro = double_it(print_value())
     values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     for n in values:
-        print(coro.send(n))
-        next(coro)
+        coro.send(n)
+    coro.close()
+
 
+@coroutine
+def print_value():
+    while (value := (yield)) is not None:
+        print(value)
 
-def generate_numbers(target):
+
+async def generate_numbers(target, delay: float = 0):
     while True:
         value = random.randint(1, 11)
-        target.send(value)
-        sleep(0.1)
+        await target.asend(value)
+        await asyncio.sleep(delay)
 
 
-@coroutine
-def double_odd(target):
+@async_coroutine
+async def double_odd(target):
     while value := (yield):
         if value % 2 != 0:
             value = value ** 2
-        target.send(value)
+        await target.asend(value)
 
 
-@coroutine
-def halve_even(target):
+@async_coroutine
+async def halve_even(target):
     while value := (yield):
         if value % 2 == 0:
             value = value // 2
-        target.send(value)
+        await target.asend(value)
 
 
-@coroutine
-def print_sum():
+@async_coroutine
+async def print_sum():
     buf = []
     while value := (yield):
         buf.append(value)
@@ -81,10 +78,14 @@ def print_sum():
             buf.clear()
 
 
+async def run_numbers_pipeline():
+    printer_sink = await print_sum()
+    even_filter = await halve_even(printer_sink)
+    odd_filter = await double_odd(even_filter)
+    await generate_numbers(odd_filter)
+
+
 if __name__ == "__main__":
     # run_cash_return_coro()
     # run_double_it_coro()
-    printer_sink = print_sum()
-    even_filter = halve_even(printer_sink)
-    odd_filter = double_odd(even_filter)
-    generate_numbers(odd_filter)
+    asyncio.run(run_numbers_pipeline())
@@ -1,9 +1,10 @@
 import abc
-import json
 import logging
 import os
 from typing import Any, Optional
 
+import msgpack
+import orjson
 from redis import Redis
 
 
@@ -13,6 +14,13 @@ class BaseStorage(abc.ABC):
         """Сохранить состояние в постоянное хранилище"""
         pass
 
+    def save_field(self, key: str, value: Any, state: dict) -> None:
+        """
+        Сохранить значение одного ключа состояния в постоянное хранилище.
+        state — всё состояние с уже применённым изменением: хранилища без частичной записи сохраняют его целиком.
+        """
+        self.save_state(state)
+
     @abc.abstractmethod
     def retrieve_state(self) -> dict:
         """Загрузить состояние локально из постоянного хранилища"""
@@ -25,15 +33,29 @@ class BaseStorage(abc.ABC):
 
 
 class JsonFileStorage(BaseStorage):
-    def __init__(self, file_path: Optional[str] = None):
+    """
+    Хранит состояние в файле.
+    По умолчанию в JSON (удобно при отладке), с флагом use_msgpack — в более компактном msgpack.
+    """
+
+    def __init__(self, file_path: Optional[str] = None, use_msgpack: bool = False):
         self.file_path = file_path
+        self.use_msgpack = use_msgpack
 
     def save_state(self, state: dict) -> None:
         if self.file_path is None:
             return
 
-        with open(self.file_path, "w") as f:
-            json.dump(state, f)
+        if self.use_msgpack:
+            data = msgpack.packb(state, use_bin_type=True)
+        else:
+            data = orjson.dumps(state)
+
+        # Пишем во временный файл и атомарно подменяем им старый, чтобы падение посреди записи не потеряло состояние
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.file_path)
 
     def retrieve_state(self) -> dict:
         if self.file_path is None:
@@ -41,10 +63,12 @@ class JsonFileStorage(BaseStorage):
             return {}
 
         try:
-            with open(self.file_path, "r") as f:
-                data = json.load(f)
+            with open(self.file_path, "rb") as f:
+                data = f.read()
 
-            return data
+            if self.use_msgpack:
+                return msgpack.unpackb(data, raw=False)
+            return orjson.loads(data)
 
         except FileNotFoundError:
             self.save_state({})
@@ -76,7 +100,7 @@ class State:
         """Установить состояние для определённого ключа"""
         self.state[key] = value
 
-        self.storage.save_state(self.state)
+        self.storage.save_field(key, value, self.state)
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу"""
@@ -87,17 +111,32 @@ class State:
 
 
 class RedisStorage(BaseStorage):
+    """
+    Хранит состояние в Redis-хеше: каждый ключ состояния — отдельное поле,
+    поэтому при обновлении одного ключа не приходится перезаписывать всё состояние.
+    """
+
+    STATE_KEY = "state"
+
     def __init__(self, redis_adapter: Redis):
         self.redis_adapter = redis_adapter
 
     def save_state(self, state: dict) -> None:
-        self.redis_adapter.set("data", json.dumps(state))
+        with self.redis_adapter.pipeline() as pipe:
+            pipe.delete(self.STATE_KEY)
+            if state:
+                pipe.hset(
+                    self.STATE_KEY,
+                    mapping={key: msgpack.packb(value, use_bin_type=True) for key, value in state.items()},
+                )
+            pipe.execute()
+
+    def save_field(self, key: str, value: Any, state: dict) -> None:
+        self.redis_adapter.hset(self.STATE_KEY, key, msgpack.packb(value, use_bin_type=True))
 
     def retrieve_state(self) -> dict:
-        raw_data = self.redis_adapter.get("data")
-        if raw_data is None:
-            return {}
-        return json.loads(raw_data)
+        raw_data = self.redis_adapter.hgetall(self.STATE_KEY)
+        return {key.decode(): msgpack.unpackb(value, raw=False) for key, value in raw_data.items()}
 
     def clean_up(self):
-        self.redis_adapter.flushdb()
+        self.redis_adapter.delete(self.STATE_KEY)
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Generator, List, Tuple
 
 
@@ -9,11 +9,8 @@ class Movie:
     dates: List[Tuple[datetime, datetime]]
 
     def schedule(self) -> Generator[datetime, None, None]:
-        delta = timedelta(days=1)
         for start_date, end_date in self.dates:
-            while start_date <= end_date:
-                yield start_date
-                start_date += delta
+            yield from map(datetime.fromordinal, range(start_date.toordinal(), end_date.toordinal() + 1))
 
 
 m = Movie("sw", [(datetime(2020, 1, 1), datetime(2020, 1, 7)), (datetime(2020, 1, 15), datetime(2020, 2, 7))])
@@ -1,23 +1,13 @@
-class CyclicIterator:
-    def __init__(self, cycles):
-        self.current = -1
-        self.start, self.step, self.stop = cycles
+import itertools
+from typing import Iterator
 
-    def __iter__(self):
-        return self
 
-    def __next__(self):
-        if self.current < self.stop:
-            self.current += 1
-            return self.current
-        else:
-            self.current = 0
-            return self.current
+def cyclic_iterator(cycles: range) -> Iterator[int]:
+    return itertools.cycle(cycles)
 
 
 def main():
-    cyclic_iterator = CyclicIterator(range(3))
-    for i in cyclic_iterator:
+    for i in cyclic_iterator(range(3)):
         print(i)
 
 
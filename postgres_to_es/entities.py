@@ -1,11 +1,11 @@
 import datetime
 from uuid import UUID
 
+import msgspec
 from pydantic.dataclasses import dataclass
 
 
-@dataclass
-class ESItem:
+class ESItem(msgspec.Struct):
     id: str
     genres: list[str]
     writers: list[str]
@@ -1,37 +1,69 @@
-import json
+import gzip
 import logging
-from dataclasses import asdict
 from datetime import datetime
 from urllib.parse import urljoin
 
 import backoff
+import msgspec
+import orjson
 import requests
 from psycopg2 import OperationalError
 from psycopg2.extensions import connection as _connection
+from psycopg2.extensions import cursor
+from requests.adapters import HTTPAdapter
 
 from etl_state import State
 from postgres_to_es.entities import ESGenreItem, ESItem, ESPersonItem
-from postgres_to_es.utils import coroutine
 
 logging.basicConfig(format="[%(asctime)s: %(levelname)s] %(message)s", level=logging.INFO)
 
+# Decimal из Postgres сериализуется числом, а не строкой
+ES_ITEM_ENCODER = msgspec.json.Encoder(decimal_format="number")
+# ES возвращает только флаг ошибок и сами ошибки, а не полный отчёт по каждому документу
+BULK_FILTER_PATH = "errors,items.*.error"
+# Минимальный уровень сжатия: ndjson и так хорошо сжимается, а CPU тратится меньше всего
+BULK_COMPRESS_LEVEL = 1
+
+
+class BulkIndexError(Exception):
+    """Elasticsearch не проиндексировал часть документов пачки"""
+
 
 class ESSaver:
     def __init__(self, url: str, state: State):
         self.url = url
         self.state = state
+        self.session = self._get_session()
 
     @staticmethod
-    def _get_es_bulk_query(rows: list[ESItem], index_name: str = "movies") -> list[str]:
+    def _get_session() -> requests.Session:
         """
-        Подготавливает bulk-запрос в Elasticsearch
+        Создаёт сессию с пулом keep-alive соединений, чтобы не открывать новое соединение на каждый batch
+        """
+        session = requests.Session()
+        session.headers.update({"Content-Type": "application/x-ndjson"})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @staticmethod
+    def _get_es_bulk_query(rows: list[ESItem], index_name: str = "movies") -> bytes:
         """
-        prepared_query = []
+        Подготавливает bulk-запрос в Elasticsearch в формате ndjson.
+        Строка действия собирается из заранее закодированных префикса и суффикса:
+        id — это uuid или число, поэтому экранировать в них нечего.
+        """
+        action_prefix = b'{"index":{"_index":' + orjson.dumps(index_name) + b',"_id":"'
+        action_suffix = b'"}}\n'
+        prepared_query = bytearray()
         for row in rows:
-            prepared_query.extend(
-                [json.dumps({"index": {"_index": index_name, "_id": row.id}}), json.dumps(asdict(row))]
-            )
-        return prepared_query
+            prepared_query += action_prefix
+            prepared_query += str(row.id).encode()
+            prepared_query += action_suffix
+            prepared_query += ES_ITEM_ENCODER.encode(row)
+            prepared_query += b"\n"
+        return bytes(prepared_query)
 
     @backoff.on_exception(
         backoff.expo,
@@ -39,30 +71,38 @@ class ESSaver:
         max_tries=3,
         jitter=backoff.random_jitter,
     )
-    @coroutine
-    def load_to_es(self, index_name: str = "movies"):
+    def save_batch(self, records: list[ESItem], index_name: str = "movies") -> None:
         """
-        Отправка запроса в ES и разбор ошибок сохранения данных
+        Отправка одной пачки в ES и разбор ошибок сохранения данных
         """
-        try:
-            while records := (yield):
-                prepared_query = self._get_es_bulk_query(records, index_name)
-                self.state.set_state("prepared_query", prepared_query)
-                str_query = "\n".join(prepared_query) + "\n"
+        prepared_query = self._get_es_bulk_query(records, index_name)
 
-                logging.info("loading movies to elastic")
-                response = requests.post(
-                    urljoin(self.url, "_bulk"), data=str_query, headers={"Content-Type": "application/x-ndjson"}
-                )
-                self.state.set_state("modified", records[0].modified)
+        logging.info("loading movies to elastic")
+        response = self.session.post(
+            urljoin(self.url, f"_bulk?filter_path={BULK_FILTER_PATH}"),
+            data=gzip.compress(prepared_query, compresslevel=BULK_COMPRESS_LEVEL),
+            # Ответ requests и так запрашивает сжатым через Accept-Encoding
+            headers={"Content-Encoding": "gzip"},
+        )
+        # Ответ с ошибкой (400, 413, 5xx) — не отчёт bulk, в нём нет флага errors
+        response.raise_for_status()
 
-                json_response = json.loads(response.content.decode())
-                for item in json_response["items"]:
-                    error_message = item["index"].get("error")
-                    if error_message:
-                        logging.error(error_message)
-        except GeneratorExit:
-            self.state.clean_up()
+        json_response = orjson.loads(response.content)
+        if json_response.get("errors"):
+            for item in json_response["items"]:
+                error_message = item["index"].get("error")
+                if error_message:
+                    logging.error(error_message)
+            # Курсор не сдвигается, поэтому следующий запуск заново выберет всю пачку:
+            # уже проиндексированные документы перезапишутся по тому же _id
+            raise BulkIndexError(f"failed to index {index_name} batch, modified cursor is not advanced")
+
+        # Пачки идут по возрастанию modified, поэтому после падения следующий запуск
+        # заново выберет из Postgres всё, что новее последней загруженной записи
+        modified = records[-1].modified
+        if isinstance(modified, datetime):
+            modified = modified.isoformat()
+        self.state.set_state(f"{index_name}_modified", modified)
 
 
 class PostgresLoader:
@@ -73,12 +113,12 @@ class PostgresLoader:
         self.state = state
 
     @backoff.on_exception(backoff.expo, OperationalError, max_tries=3, jitter=backoff.random_jitter)
-    def load_movies(self, coro):
+    def load_movies(self, sink):
         """
         Основной метод для ETL.
         """
         with self.conn.cursor() as cur:
-            modified = self.state.get_state("modified")
+            modified = self.state.get_state("movies_modified")
             if not modified:
                 logging.info("fetching min modified field")
                 cur.execute(
@@ -90,78 +130,68 @@ class PostgresLoader:
                 modified = cur.fetchone()["min_modified"]
             else:
                 modified = datetime.fromisoformat(modified)
-            logging.info("loading cast")
-            cur.execute(
-                """
-                    SELECT "movies_person"."uuid"
-                    FROM "movies_person"
-                    WHERE "movies_person"."modified" >= %(modified)s
-                    ORDER BY "movies_person"."modified";
-                """,
-                {"modified": modified},
-            )
-            raw_cast_ids = cur.fetchall()
-            cast_ids = [uuid["uuid"] for uuid in raw_cast_ids]
-
-            logging.info("loading film_work_ids")
-            cur.execute(
-                """
-                SELECT DISTINCT fw.id, fw.modified
-                    FROM movies_filmwork fw
-                    LEFT JOIN movies_cast pfw ON pfw.film_work_id = fw.id
-                    WHERE fw.modified >= %(modified)s OR pfw.person_id::text = ANY(%(cast_ids)s)
-                    ORDER BY fw.modified;
-                """,
-                {"cast_ids": cast_ids or [], "modified": modified},
-            )
-            raw_film_work_ids = cur.fetchall()
-            film_work_ids = [id_["id"] for id_ in raw_film_work_ids]
-
             logging.info("loading film_works")
-            cur.execute(
-                """
-                SELECT
-                    "movies_filmwork"."title",
-                    "movies_filmwork"."description",
-                    "movies_filmwork"."rating",
-                    "movies_filmwork"."modified",
-                    "movies_filmwork"."uuid" AS "id",
-                ARRAY_AGG("movies_genre"."genre" ) AS "genres",
-                ARRAY_AGG(CONCAT("movies_person"."first_name", ' ', "movies_person"."last_name") )
-                FILTER (WHERE "movies_role"."role" = 'actor') AS "actors",
-                ARRAY_AGG(CONCAT("movies_person"."first_name", ' ', "movies_person"."last_name") )
-                FILTER (WHERE "movies_role"."role" = 'director') AS "directors",
-                ARRAY_AGG(CONCAT("movies_person"."first_name", ' ', "movies_person"."last_name") )
-                FILTER (WHERE "movies_role"."role" = 'writer') AS "writers"
-                FROM "movies_filmwork"
-                LEFT OUTER JOIN "movies_filmwork_genres"
-                    ON ("movies_filmwork"."id" = "movies_filmwork_genres"."filmwork_id")
-                LEFT OUTER JOIN "movies_genre"
-                    ON ("movies_filmwork_genres"."genre_id" = "movies_genre"."id")
-                LEFT OUTER JOIN "movies_cast"
-                    ON ("movies_filmwork"."id" = "movies_cast"."film_work_id")
-                LEFT OUTER JOIN "movies_person"
-                    ON ("movies_cast"."person_id" = "movies_person"."uuid")
-                LEFT OUTER JOIN "movies_role" ON ("movies_cast"."role_id" = "movies_role"."id")
-                WHERE "movies_filmwork"."id" = ANY(%(film_work_ids)s)
-                GROUP BY "movies_filmwork"."title", "movies_filmwork"."description", "movies_filmwork"."creation_date",
-                "movies_filmwork"."rating", "movies_filmwork"."modified", "movies_filmwork"."uuid"
-                ORDER BY "movies_filmwork"."modified" DESC;
-            """,
-                {"film_work_ids": film_work_ids or []},
-            )
-            while rows := cur.fetchmany(self.BATCH_LIMIT):
-                if not rows:
-                    coro.close()
-                coro.send(rows)
+            # Серверный курсор отдаёт строки пачками по itersize, а не загружает весь результат в память.
+            # Строки — обычные кортежи: prepare_movies распаковывает их по порядку колонок
+            with self.conn.cursor(name="movies_stream", cursor_factory=cursor) as stream:
+                stream.itersize = self.BATCH_LIMIT
+                stream.execute(
+                    """
+                    WITH "changed_people" AS (
+                        SELECT "movies_person"."uuid"
+                        FROM "movies_person"
+                        WHERE "movies_person"."modified" >= %(modified)s
+                    ),
+                    "changed_film_works" AS (
+                        SELECT DISTINCT fw.id
+                        FROM movies_filmwork fw
+                        LEFT JOIN movies_cast pfw ON pfw.film_work_id = fw.id
+                        WHERE fw.modified >= %(modified)s
+                            OR pfw.person_id IN (SELECT "changed_people"."uuid" FROM "changed_people")
+                    )
+                    SELECT
+                        "movies_filmwork"."title",
+                        "movies_filmwork"."description",
+                        "movies_filmwork"."rating",
+                        "movies_filmwork"."modified",
+                        "movies_filmwork"."uuid" AS "id",
+                    ARRAY_AGG("movies_genre"."genre" ) AS "genres",
+                    ARRAY_AGG(CONCAT("movies_person"."first_name", ' ', "movies_person"."last_name") )
+                    FILTER (WHERE "movies_role"."role" = 'actor') AS "actors",
+                    ARRAY_AGG(CONCAT("movies_person"."first_name", ' ', "movies_person"."last_name") )
+                    FILTER (WHERE "movies_role"."role" = 'director') AS "directors",
+                    ARRAY_AGG(CONCAT("movies_person"."first_name", ' ', "movies_person"."last_name") )
+                    FILTER (WHERE "movies_role"."role" = 'writer') AS "writers"
+                    FROM "movies_filmwork"
+                    JOIN "changed_film_works" ON ("movies_filmwork"."id" = "changed_film_works"."id")
+                    LEFT OUTER JOIN "movies_filmwork_genres"
+                        ON ("movies_filmwork"."id" = "movies_filmwork_genres"."filmwork_id")
+                    LEFT OUTER JOIN "movies_genre"
+                        ON ("movies_filmwork_genres"."genre_id" = "movies_genre"."id")
+                    LEFT OUTER JOIN "movies_cast"
+                        ON ("movies_filmwork"."id" = "movies_cast"."film_work_id")
+                    LEFT OUTER JOIN "movies_person"
+                        ON ("movies_cast"."person_id" = "movies_person"."uuid")
+                    LEFT OUTER JOIN "movies_role" ON ("movies_cast"."role_id" = "movies_role"."id")
+                    GROUP BY "movies_filmwork"."title", "movies_filmwork"."description",
+                    "movies_filmwork"."creation_date", "movies_filmwork"."rating",
+                    "movies_filmwork"."modified", "movies_filmwork"."uuid"
+                    ORDER BY "movies_filmwork"."modified";
+                """,
+                    {"modified": modified},
+                )
+                while rows := stream.fetchmany(self.BATCH_LIMIT):
+                    if not rows:
+                        sink.close()
+                    sink.send(rows)
 
     @backoff.on_exception(backoff.expo, OperationalError, max_tries=3, jitter=backoff.random_jitter)
-    def load_genres(self, coro):
+    def load_genres(self, sink):
         """
         Основной метод для ETL загрузки жанров.
         """
         with self.conn.cursor() as cur:
-            modified = self.state.get_state("modified")
+            modified = self.state.get_state("genres_modified")
             if not modified:
                 logging.info("fetching min modified field")
                 cur.execute(
@@ -185,16 +215,16 @@ class PostgresLoader:
 
             while rows := cur.fetchmany(self.BATCH_LIMIT):
                 if not rows:
-                    coro.close()
-                coro.send(rows)
+                    sink.close()
+                sink.send(rows)
 
     @backoff.on_exception(backoff.expo, OperationalError, max_tries=3, jitter=backoff.random_jitter)
-    def load_people(self, coro):
+    def load_people(self, sink):
         """
         Основной метод для ETL загрузка актеров, сценаристов и режиссёров.
         """
         with self.conn.cursor() as cur:
-            modified = self.state.get_state("modified")
+            modified = self.state.get_state("people_modified")
             if not modified:
                 logging.info("fetching min modified field")
                 cur.execute(
@@ -218,69 +248,60 @@ class PostgresLoader:
 
             while rows := cur.fetchmany(self.BATCH_LIMIT):
                 if not rows:
-                    coro.close()
-                coro.send(rows)
+                    sink.close()
+                sink.send(rows)
 
     @staticmethod
-    @coroutine
-    def transform_data(coro):
-        logging.info("transforming film_works to load into elastic")
-        try:
-            while raw_data := (yield):
-                records = []
-                for film_work in raw_data:
-                    es_item = ESItem(
-                        id=film_work["id"],
-                        title=film_work["title"],
-                        description=film_work["description"],
-                        imdb_rating=film_work["rating"],
-                        modified=film_work["modified"].isoformat(),
-                        actors=film_work["actors"] or [],
-                        writers=film_work["writers"] or [],
-                        directors=film_work["directors"] or [],
-                        genres=film_work["genres"] or [],
-                    )
-                    records.append(es_item)
-                coro.send(records)
-        except GeneratorExit:
-            coro.close()
+    def prepare_movies(raw_data: list[tuple]) -> list[ESItem]:
+        """
+        Преобразует пачку строк из Postgres в документы индекса movies.
+        Порядок колонок совпадает с SELECT в load_movies.
+        """
+        return [
+            ESItem(
+                id_,
+                genres or [],
+                writers or [],
+                actors or [],
+                rating,
+                modified.isoformat(),
+                title,
+                directors or [],
+                description,
+            )
+            for title, description, rating, modified, id_, genres, actors, directors, writers in raw_data
+        ]
 
     @staticmethod
-    @coroutine
-    def transform_genres(coro):
-        logging.info("transforming genres to load into elastic")
-        try:
-            while raw_data := (yield):
-                records = []
-                for genre in raw_data:
-                    es_item = ESGenreItem(
-                        id=genre["id"],
-                        modified=genre["modified"],
-                        created=genre["created"],
-                        genre=genre["genre"],
-                    )
-                    records.append(es_item)
-                coro.send(records)
-        except GeneratorExit:
-            coro.close()
+    def prepare_genres(raw_data: list) -> list[ESGenreItem]:
+        """
+        Преобразует пачку строк из Postgres в документы индекса genres
+        """
+        records = []
+        for genre in raw_data:
+            es_item = ESGenreItem(
+                id=genre["id"],
+                modified=genre["modified"],
+                created=genre["created"],
+                genre=genre["genre"],
+            )
+            records.append(es_item)
+        return records
 
     @staticmethod
-    @coroutine
-    def transform_people(coro):
-        logging.info("transforming people to load into elastic")
-        try:
-            while raw_data := (yield):
-                records = []
-                for person in raw_data:
-                    es_item = ESPersonItem(
-                        id=person["uuid"],
-                        modified=person["modified"],
-                        created=person["created"],
-                        birth_date=person["genre"],
-                        first_name=person["first_name"],
-                        last_name=person["last_name"],
-                    )
-                    records.append(es_item)
-                coro.send(records)
-        except GeneratorExit:
-            coro.close()
+    def prepare_people(raw_data: list) -> list[ESPersonItem]:
+        """
+        Преобразует пачку строк из Postgres в документы индекса people
+        """
+        records = []
+        for person in raw_data:
+            es_item = ESPersonItem(
+                id=person["uuid"],
+                modified=person["modified"],
+                created=person["created"],
+                birth_date=person["genre"],
+                first_name=person["first_name"],
+                last_name=person["last_name"],
+            )
+            records.append(es_item)
+        return records
@@ -1,4 +1,8 @@
+import asyncio
+import logging
 import os
+import threading
+from typing import Any, Callable
 
 import psycopg2
 from psycopg2.extensions import connection as _connection
@@ -9,10 +13,85 @@ from etl_state import RedisStorage, State
 from postgres_to_es.etl import ESSaver, PostgresLoader
 
 BASE_ES_URL = os.getenv("ELASTIC_URL")
+# Не меньше 2, чтобы чтение из Postgres шло вперёд, пока предыдущая пачка загружается в ES
+QUEUE_MAXSIZE = max(int(os.getenv("ETL_QUEUE_MAXSIZE", 4)), 2)
 redis = Redis(host=os.getenv("REDIS_HOST"), port=os.getenv("REDIS_PORT"))
 
 
-def pipeline(pg_conn: _connection, es_url: str, redis_client: Redis):
+class PipelineStopped(Exception):
+    """Одна из стадий упала, поэтому чтение из Postgres нужно прервать"""
+
+
+class QueueSink:
+    """
+    Приёмник для PostgresLoader.load_*, который передаёт пачки из потока чтения Postgres в asyncio.Queue.
+    Пока очередь заполнена, поток чтения ждёт, поэтому стадии не убегают друг от друга.
+    """
+
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop, stopped: threading.Event):
+        self.queue = queue
+        self.loop = loop
+        self.stopped = stopped
+
+    def send(self, rows: list) -> None:
+        if self.stopped.is_set():
+            raise PipelineStopped
+        asyncio.run_coroutine_threadsafe(self.queue.put(rows), self.loop).result()
+        # Очередь постоянно заполнена — чтение из Postgres обгоняет преобразование и загрузку
+        logging.info("raw queue size after put: %s", self.queue.qsize())
+
+    def close(self) -> None:
+        """Конец данных отмечает produce, поэтому здесь ничего делать не нужно"""
+        pass
+
+
+async def produce(load: Callable[[Any], None], queue: asyncio.Queue, stopped: threading.Event) -> None:
+    """Читает пачки из Postgres в отдельном потоке и кладёт их в очередь"""
+    await asyncio.to_thread(load, QueueSink(queue, asyncio.get_running_loop(), stopped))
+    await queue.put(None)
+
+
+async def transform(prepare: Callable[[list], list], raw_queue: asyncio.Queue, es_queue: asyncio.Queue) -> None:
+    """Преобразует пачки строк из Postgres в документы Elasticsearch"""
+    while (rows := await raw_queue.get()) is not None:
+        logging.info("queue sizes: raw=%s, es=%s", raw_queue.qsize(), es_queue.qsize())
+        await es_queue.put(prepare(rows))
+    await es_queue.put(None)
+
+
+async def save(elastic_saver: ESSaver, es_queue: asyncio.Queue, index_name: str) -> None:
+    """Отправляет пачки документов в Elasticsearch, не блокируя чтение из Postgres"""
+    while (records := await es_queue.get()) is not None:
+        await asyncio.to_thread(elastic_saver.save_batch, records, index_name)
+
+
+async def run_etl(
+    load: Callable[[Any], None], prepare: Callable[[list], list], elastic_saver: ESSaver, index_name: str
+) -> None:
+    """Запускает чтение, преобразование и загрузку одного индекса параллельно, связав их очередями"""
+    logging.info("running etl for %s", index_name)
+    raw_queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+    es_queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+    stopped = threading.Event()
+    stages = [
+        asyncio.create_task(produce(load, raw_queue, stopped)),
+        asyncio.create_task(transform(prepare, raw_queue, es_queue)),
+        asyncio.create_task(save(elastic_saver, es_queue, index_name)),
+    ]
+    try:
+        await asyncio.gather(*stages)
+    except BaseException:
+        # Останавливаем оставшиеся стадии и освобождаем место в очереди,
+        # чтобы поток чтения не завис в QueueSink.send и увидел флаг остановки
+        stopped.set()
+        for stage in stages:
+            stage.cancel()
+        while not raw_queue.empty():
+            raw_queue.get_nowait()
+        raise
+
+
+async def pipeline(pg_conn: _connection, es_url: str, redis_client: Redis):
     """Основной метод загрузки данных из Postgres в Elasticsearch"""
 
     redis_client = RedisStorage(redis_client)
@@ -20,17 +99,9 @@ def pipeline(pg_conn: _connection, es_url: str, redis_client: Redis):
     elastic_saver = ESSaver(es_url, state=state)
     postgres_loader = PostgresLoader(pg_conn, state=state)
 
-    elastic_coro = elastic_saver.load_to_es()
-    elastic_prepared_data = postgres_loader.transform_data(elastic_coro)
-    postgres_loader.load_movies(elastic_prepared_data)
-
-    elastic_coro = elastic_saver.load_to_es(index_name="genres")
-    elastic_prepared_data = postgres_loader.transform_genres(elastic_coro)
-    postgres_loader.load_genres(elastic_prepared_data)
-
-    elastic_coro = elastic_saver.load_to_es(index_name="people")
-    elastic_prepared_data = postgres_loader.transform_data(elastic_coro)
-    postgres_loader.load_people(elastic_prepared_data)
+    await run_etl(postgres_loader.load_movies, postgres_loader.prepare_movies, elastic_saver, index_name="movies")
+    await run_etl(postgres_loader.load_genres, postgres_loader.prepare_genres, elastic_saver, index_name="genres")
+    await run_etl(postgres_loader.load_people, postgres_loader.prepare_people, elastic_saver, index_name="people")
 
 
 if __name__ == "__main__":
@@ -42,4 +113,4 @@ if __name__ == "__main__":
         "port": os.getenv("DB_PORT"),
     }
     with psycopg2.connect(**dsl, cursor_factory=RealDictCursor) as pg_conn:
-        pipeline(pg_conn, BASE_ES_URL, redis_client=redis)
+        asyncio.run(pipeline(pg_conn, BASE_ES_URL, redis_client=redis))
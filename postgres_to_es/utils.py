@@ -9,3 +9,13 @@ def coroutine(func):
         return fn
 
     return inner
+
+
+def async_coroutine(func):
+    @wraps(func)
+    async def inner(*args, **kwargs):
+        fn = func(*args, **kwargs)
+        await fn.asend(None)
+        return fn
+
+    return inner
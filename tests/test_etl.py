@@ -0,0 +1,83 @@
+from datetime import datetime
+from decimal import Decimal
+
+import orjson
+import pytest
+import requests
+
+from etl_state import JsonFileStorage, State
+from postgres_to_es.entities import ESGenreItem, ESItem
+from postgres_to_es.etl import BulkIndexError, ESSaver
+
+MOVIE = ESItem(
+    id="3d8b0e8e-6b3c-4d2e-9a4a-8b1f2d7c5e10",
+    genres=["Drama"],
+    writers=[],
+    actors=[],
+    imdb_rating=7.5,
+    modified="2021-06-16T20:14:09",
+    title="The Star",
+    directors=[],
+    description="",
+)
+
+
+class StubSession:
+    """Заглушка requests.Session, которая отвечает заранее заданным отчётом bulk"""
+
+    def __init__(self, report: dict):
+        self.report = report
+
+    def post(self, url: str, data: bytes, **kwargs) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response._content = orjson.dumps(self.report)
+        return response
+
+
+def test_save_batch_keeps_cursor_when_bulk_reports_errors(tmp_path):
+    state = State(JsonFileStorage(str(tmp_path / "state.json")))
+    saver = ESSaver("http://elastic:9200/", state)
+    saver.session = StubSession({"errors": True, "items": [{"index": {"error": {"type": "mapper_parsing_exception"}}}]})
+
+    with pytest.raises(BulkIndexError):
+        saver.save_batch([MOVIE])
+
+    assert state.get_state("movies_modified") is None
+
+
+def test_save_batch_advances_cursor_after_successful_bulk(tmp_path):
+    state = State(JsonFileStorage(str(tmp_path / "state.json")))
+    saver = ESSaver("http://elastic:9200/", state)
+    saver.session = StubSession({"errors": False})
+
+    saver.save_batch([MOVIE])
+
+    assert state.get_state("movies_modified") == MOVIE.modified
+
+
+def test_get_es_bulk_query_alternates_action_and_document_lines():
+    movie = ESItem(
+        id="0a1b2c3d-0000-4000-8000-000000000001",
+        genres=["Comedy"],
+        writers=[],
+        actors=["Jim Carrey"],
+        imdb_rating=Decimal("8.1"),
+        modified="2021-06-16T20:14:09",
+        title="The Mask",
+        directors=None,
+        description="",
+    )
+    genre = ESGenreItem(id=7, modified=datetime(2021, 6, 16), created=datetime(2021, 6, 16), genre="Comedy")
+
+    body = ESSaver._get_es_bulk_query([movie, genre], index_name="movies")
+
+    assert body.endswith(b"\n")
+    lines = body.splitlines()
+    assert len(lines) == 4
+    parsed = [orjson.loads(line) for line in lines]
+    actions, documents = parsed[::2], parsed[1::2]
+    assert actions == [{"index": {"_index": "movies", "_id": movie.id}}, {"index": {"_index": "movies", "_id": "7"}}]
+    assert documents[0]["imdb_rating"] == 8.1
+    assert documents[0]["directors"] is None
+    assert documents[1]["id"] == 7
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+
+from postgres_to_es.load_data import QUEUE_MAXSIZE, run_etl
+
+BATCH_COUNT = QUEUE_MAXSIZE * 10
+
+
+class StubSaver:
+    """Заглушка ESSaver, которая запоминает пачки или падает, как недоступный Elasticsearch"""
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.saved = []
+
+    def save_batch(self, records: list, index_name: str = "movies") -> None:
+        if self.fail:
+            raise RuntimeError("elasticsearch is down")
+        self.saved.extend(records)
+
+
+def load(sink):
+    for batch in range(BATCH_COUNT):
+        sink.send([batch])
+
+
+def test_run_etl_loads_every_batch():
+    saver = StubSaver()
+
+    asyncio.run(run_etl(load, lambda rows: rows, saver, index_name="movies"))
+
+    assert saver.saved == list(range(BATCH_COUNT))
+
+
+def test_run_etl_raises_when_save_batch_fails():
+    saver = StubSaver(fail=True)
+    errors = []
+
+    def run():
+        try:
+            asyncio.run(run_etl(load, lambda rows: rows, saver, index_name="movies"))
+        except RuntimeError as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive(), "run_etl hangs after a stage failure"
+    assert [str(exc) for exc in errors] == ["elasticsearch is down"]